@@ -1,9 +1,20 @@
 from flask import Flask, request, jsonify
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import hmac
 import os
-from google import genai
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from supabase import create_client, Client
 
 load_dotenv()
 
@@ -12,29 +23,453 @@ app = Flask(__name__)
 # Load our Secrets
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
 NEWS_API_KEY = os.environ.get("NEWS_API_KEY")
+CRON_SECRET = os.environ.get("CRON_SECRET")
+SEND_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage" if TELEGRAM_TOKEN else None
+CHAT_ACTION_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendChatAction" if TELEGRAM_TOKEN else None
+EDIT_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/editMessageText" if TELEGRAM_TOKEN else None
 
-# Initialize Supabase
-supabase: Client = None
-try:
-    url = os.environ.get("SUPABASE_URL")
-    key = os.environ.get("SUPABASE_KEY") or os.environ.get("SUPABASE_ANON_KEY")
-    if url and key:
-        supabase = create_client(url, key)
-    else:
+# Upper bounds for SDK calls, so a hung Supabase or Gemini request can't hold the
+# invocation until Vercel kills it (the SDK defaults are 120s and unbounded).
+SUPABASE_TIMEOUT = 10      # seconds
+GEMINI_TIMEOUT_MS = 30000  # the genai SDK takes milliseconds
+
+# Supabase and Gemini clients are created on first use, so commands that don't
+# need them (e.g. /start) don't pay for importing and initializing their SDKs
+# on a cold start.
+@lru_cache(maxsize=1)
+def get_supabase():
+    """Returns the Supabase client, or None if it isn't configured."""
+    try:
+        url = os.environ.get("SUPABASE_URL")
+        key = os.environ.get("SUPABASE_KEY") or os.environ.get("SUPABASE_ANON_KEY")
+        if url and key:
+            from supabase import ClientOptions, create_client
+            return create_client(url, key, options=ClientOptions(postgrest_client_timeout=SUPABASE_TIMEOUT))
         print("Warning: SUPABASE_URL or SUPABASE_KEY is missing.")
-except Exception as e:
-    print(f"Warning: Supabase Client failed to initialize: {e}")
-
-# Initialize the Gemini Client. 
-# It automatically picks up the GEMINI_API_KEY environment variable.
-try:
-    client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
-except Exception as e:
-    print(f"Warning: Gemini Client failed to initialize: {e}")
-    client = None
-
-def analyze_sentiment(coin):
-    """Fetches news and asks Gemini to analyze the sentiment."""
+    except Exception as e:
+        print(f"Warning: Supabase Client failed to initialize: {e}")
+    return None
+
+# The Gemini SDK talks over httpx, so it can use HTTP/2: the batched sentiment
+# calls and their per-coin fallbacks, which run concurrently on IO_EXECUTOR,
+# share one multiplexed connection.
+@lru_cache(maxsize=1)
+def get_gemini():
+    """Returns the Gemini client, or None if it failed to initialize."""
+    try:
+        from google import genai
+        return genai.Client(
+            api_key=os.environ.get("GEMINI_API_KEY"),
+            http_options={'timeout': GEMINI_TIMEOUT_MS, 'client_args': {'http2': True}}
+        )
+    except Exception as e:
+        print(f"Warning: Gemini Client failed to initialize: {e}")
+        return None
+
+# Optional job queue (e.g. Upstash Redis) so the cron job can hand users off to
+# RQ workers instead of processing them inside one serverless invocation.
+queue = None
+REDIS_URL = os.environ.get("REDIS_URL")
+if REDIS_URL:
+    try:
+        from redis import ConnectionPool, Redis
+        from rq import Queue
+        # Keepalive plus periodic health checks let a warm instance reuse its TLS
+        # connection to Upstash instead of finding it silently dropped. No
+        # decode_responses: RQ stores pickled job data as bytes.
+        _redis_pool = ConnectionPool.from_url(
+            REDIS_URL,
+            max_connections=16,
+            socket_keepalive=True,
+            socket_timeout=5,
+            socket_connect_timeout=3,
+            health_check_interval=30,
+        )
+        queue = Queue('cron', connection=Redis(connection_pool=_redis_pool))
+    except Exception as e:
+        print(f"Warning: job queue failed to initialize, cron will run inline: {e}")
+
+# Thread counts. Each thread holds at most one connection per host, so the HTTP
+# pools below are sized to HTTP_POOL_SIZE >= both of these to avoid discarding
+# sockets under full fan-out.
+IO_WORKERS = 32    # leaf network calls (IO_EXECUTOR)
+CRON_WORKERS = 16  # users processed in parallel by an inline cron run
+HTTP_POOL_SIZE = max(IO_WORKERS, CRON_WORKERS)
+
+# Shared HTTP session so repeat calls to Telegram, NewsAPI and CoinGecko
+# reuse keep-alive connections instead of doing a new TLS handshake each time.
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=HTTP_POOL_SIZE,
+    # raise_on_status=False: once retries run out, hand back the last response
+    # for the callers' status checks instead of a RetryError (whose message
+    # includes the full request URL).
+    # 429s aren't retried and Retry-After is ignored: a rate-limited host can ask
+    # for a minute or more, which would park the request thread. Backing off is
+    # left to the callers (AdaptiveTokenBucket, the coin list's retry delay).
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.3,
+        status_forcelist=[500, 502, 503, 504],
+        respect_retry_after_header=False,
+        raise_on_status=False,
+    ),
+)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+# Telegram gets its own pool and also retries sendMessage POSTs on connection
+# errors and 5xx. 429s are left to send_message, which honours retry_after.
+# As above, a final 5xx comes back as a response rather than a RetryError.
+SESSION.mount("https://api.telegram.org/", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=HTTP_POOL_SIZE,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=frozenset({'GET', 'POST'}),
+        respect_retry_after_header=False,
+        raise_on_status=False,
+    ),
+))
+# Ask for compressed bodies (NewsAPI/CoinGecko JSON shrinks ~5x). No "br": urllib3
+# can only decode brotli if the optional brotli package is installed.
+SESSION.headers.update({
+    'Accept-Encoding': 'gzip, deflate',
+    'Connection': 'keep-alive',
+    'User-Agent': 'cryptobobomb/1.0',
+})
+
+# (connect, read) timeouts for every outbound call
+HTTP_TIMEOUT = (3, 10)
+# Outbound JSON bodies are pre-encoded with orjson and sent as data=
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# coin_state rows older than this are ignored by /watchlist (cron runs every 30 minutes)
+COIN_STATE_MAX_AGE = 35 * 60  # seconds
+
+# Shared pool for overlapping leaf network calls (NewsAPI, CoinGecko).
+# It survives across warm invocations, so requests don't pay for spinning up threads.
+# Only submit work here that doesn't itself wait on this pool.
+IO_EXECUTOR = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+
+# Sentiment cache: in-process TTL cache, backed by the Supabase `sentiment_cache`
+# table so other serverless instances can reuse results.
+SENTIMENT_TTL = 600  # seconds
+_SENT_CACHE = TTLCache(maxsize=512, ttl=SENTIMENT_TTL)
+_SENT_CACHE_LOCK = threading.Lock()
+
+# "No headlines" is cached under a sentinel for longer, so obscure coins don't
+# burn NewsAPI quota (100 requests/day on the free tier) on every cron tick.
+NO_NEWS = "__NO_NEWS__"
+NO_NEWS_TTL = 1800  # seconds
+_NO_NEWS_CACHE = TTLCache(maxsize=1024, ttl=NO_NEWS_TTL)
+
+# Known CoinGecko coins, downloaded once per instance and refreshed daily
+COIN_LIST_TTL = 24 * 3600  # seconds
+# After a failed download, wait this long before trying CoinGecko again
+COIN_LIST_RETRY = 5 * 60  # seconds
+_KNOWN_COINS = None
+_KNOWN_COINS_LOADED_AT = 0
+_KNOWN_COINS_FAILED_AT = 0
+_KNOWN_COINS_LOCK = threading.Lock()
+
+def _load_known_coins():
+    """
+    Returns (ids, ids plus symbols and names) as lowercase sets, or None if the
+    CoinGecko list can't be loaded.
+    """
+    global _KNOWN_COINS, _KNOWN_COINS_LOADED_AT, _KNOWN_COINS_FAILED_AT
+    # While another thread refreshes a stale list, keep using the old one
+    # instead of queueing behind the download
+    if not _KNOWN_COINS_LOCK.acquire(blocking=_KNOWN_COINS is None):
+        return _KNOWN_COINS
+    try:
+        now = time.time()
+        if _KNOWN_COINS is not None and now - _KNOWN_COINS_LOADED_AT < COIN_LIST_TTL:
+            return _KNOWN_COINS
+        if now - _KNOWN_COINS_FAILED_AT < COIN_LIST_RETRY:
+            return _KNOWN_COINS
+        try:
+            response = SESSION.get("https://api.coingecko.com/api/v3/coins/list", timeout=HTTP_TIMEOUT)
+            response.raise_for_status()
+            ids, known = set(), set()
+            for entry in orjson.loads(response.content):
+                ids.add(str(entry.get('id', '')).lower())
+                known.update(str(entry.get(field, '')).lower() for field in ('symbol', 'name'))
+            ids.discard('')
+            known.discard('')
+            _KNOWN_COINS = (ids, known | ids)
+            _KNOWN_COINS_LOADED_AT = time.time()
+        except Exception as e:
+            # Keep whatever we had; validation is skipped if we never loaded a list
+            print(f"Warning: could not load CoinGecko coin list: {e}")
+            _KNOWN_COINS_FAILED_AT = time.time()
+        return _KNOWN_COINS
+    finally:
+        _KNOWN_COINS_LOCK.release()
+
+def is_known_coin(coin, ids_only=False):
+    """
+    True if coin is a CoinGecko id, or a symbol or name unless ids_only
+    (or if the list is unavailable).
+    """
+    known = _load_known_coins()
+    return known is None or coin in known[0 if ids_only else 1]
+
+def _read_sentiment_cache(coins):
+    """Returns {coin: sentiment} for the coins with a non-expired Supabase entry, in one query."""
+    supabase = get_supabase()
+    if not supabase or not coins:
+        return {}
+    try:
+        now = datetime.now(timezone.utc).isoformat()
+        response = supabase.table('sentiment_cache').select('coin,sentiment').in_('coin', coins).gt('expires_at', now).execute()
+        return {row['coin']: row['sentiment'] for row in response.data}
+    except Exception as e:
+        print(f"Sentiment cache read failed: {e}")
+    return {}
+
+def _write_sentiment_cache(rows):
+    """Upserts (coin, sentiment, ttl) rows into Supabase in one request, expiring ttl seconds from now."""
+    supabase = get_supabase()
+    if not supabase or not rows:
+        return
+    try:
+        now = datetime.now(timezone.utc)
+        supabase.table('sentiment_cache').upsert([
+            {
+                "coin": coin,
+                "sentiment": sentiment,
+                "expires_at": (now + timedelta(seconds=ttl)).isoformat()
+            }
+            for coin, sentiment, ttl in rows
+        ]).execute()
+    except Exception as e:
+        print(f"Sentiment cache write failed: {e}")
+
+def _cache_get(coins):
+    """
+    Looks up cached sentiments (or NO_NEWS), in memory first and then in Supabase.
+    Returns {coin: sentiment} for the hits only.
+    """
+    hits = {}
+    with _SENT_CACHE_LOCK:
+        for coin in coins:
+            sentiment = _SENT_CACHE.get(coin) or _NO_NEWS_CACHE.get(coin)
+            if sentiment is not None:
+                hits[coin] = sentiment
+
+    # Everything memory didn't have is fetched from Supabase in a single round trip
+    shared = _read_sentiment_cache([coin for coin in coins if coin not in hits])
+    if shared:
+        with _SENT_CACHE_LOCK:
+            for coin, sentiment in shared.items():
+                (_NO_NEWS_CACHE if sentiment == NO_NEWS else _SENT_CACHE)[coin] = sentiment
+        hits.update(shared)
+    return hits
+
+def _cache_put(sentiments, ttl=None):
+    """
+    Caches freshly computed {coin: sentiment}. Failures are skipped so the next call retries.
+    ttl overrides how long the shared Supabase entries live (the cron job uses this).
+    """
+    rows = []
+    with _SENT_CACHE_LOCK:
+        for coin, sentiment in sentiments.items():
+            if sentiment.startswith("Error"):
+                continue
+            default_ttl = NO_NEWS_TTL if sentiment == NO_NEWS else SENTIMENT_TTL
+            (_NO_NEWS_CACHE if sentiment == NO_NEWS else _SENT_CACHE)[coin] = sentiment
+            rows.append((coin, sentiment, max(ttl or 0, default_ttl)))
+    _write_sentiment_cache(rows)
+
+def _present(coin, sentiment):
+    """Turns the NO_NEWS sentinel into the user-facing message."""
+    return f"No recent news found for {coin}." if sentiment == NO_NEWS else sentiment
+
+def analyze_sentiment(coin, stream=None):
+    """
+    Returns the sentiment for a coin, served from cache while it is fresh.
+    On a miss, a StreamedReply passed as stream shows Gemini's answer as it is generated.
+    """
+    coin = coin.strip().lower()
+
+    sentiment = _cache_get([coin]).get(coin)
+    if sentiment is None:
+        sentiment = _analyze_sentiment_live(coin, stream=stream)
+        _cache_put({coin: sentiment})
+    return _present(coin, sentiment)
+
+def analyze_sentiment_batch(coins):
+    """
+    Returns {coin: sentiment} for several coins.
+    Cached coins are served from cache; the rest share a single Gemini call.
+    """
+    coins = list(dict.fromkeys(c.strip().lower() for c in coins))
+    results = _cache_get(coins)
+    misses = [coin for coin in coins if coin not in results]
+
+    if misses:
+        fresh = _analyze_sentiment_batch_live(misses)
+        _cache_put(fresh)
+        results.update(fresh)
+    return {coin: _present(coin, sentiment) for coin, sentiment in results.items()}
+
+class NewsAPIError(Exception):
+    """Raised when NewsAPI returns a non-200 response."""
+
+def _news_json(response):
+    """Parses a NewsAPI response body, raising NewsAPIError unless it is a 200 with JSON."""
+    try:
+        data = orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        raise NewsAPIError(f"HTTP {response.status_code}, body is not JSON")
+    if response.status_code != 200:
+        raise NewsAPIError(data.get('message') or f"HTTP {response.status_code}")
+    return data
+
+# Failure replies shown to users. Details (which can quote URLs or upstream
+# messages) are only logged. They start with "Error" so they are never cached.
+NEWS_ERROR_REPLY = "Error fetching news. Please try again later."
+SENTIMENT_ERROR_REPLY = "Error analyzing sentiment. Please try again later."
+
+# Headlines per coin, kept briefly so a retry after a failed Gemini call (which
+# isn't cached as a sentiment) doesn't spend NewsAPI quota again.
+HEADLINES_TTL = 300  # seconds
+_HEADLINES_CACHE = TTLCache(maxsize=256, ttl=HEADLINES_TTL)
+_HEADLINES_CACHE_LOCK = threading.Lock()
+
+def _fetch_headlines(coin):
+    """Returns the latest (up to 5) news headlines mentioning coin."""
+    with _HEADLINES_CACHE_LOCK:
+        headlines = _HEADLINES_CACHE.get(coin)
+    if headlines is None:
+        headlines = _fetch_headlines_live(coin)
+        with _HEADLINES_CACHE_LOCK:
+            _HEADLINES_CACHE[coin] = headlines
+    return headlines
+
+def _fetch_headlines_live(coin):
+    """Asks NewsAPI for the latest (up to 5) headlines mentioning coin."""
+    news_response = _news_get(
+        "https://newsapi.org/v2/everything",
+        params={
+            'q': coin,
+            'searchIn': 'title',
+            'language': 'en',
+            'sortBy': 'publishedAt',
+            'pageSize': 5,
+        }
+    )
+    news_data = _news_json(news_response)
+
+    # Only titles are used; skip removed articles, which come back as "[Removed]" or without one
+    return [
+        article['title'] for article in news_data.get('articles', ())
+        if article.get('title') and article['title'] != '[Removed]'
+    ][:5]
+
+# NewsAPI caps q at 500 characters, so large coin sets are split across queries
+NEWS_QUERY_MAX_CHARS = 500
+
+def _chunk_news_query(coins):
+    """Yields lists of coins whose quoted, OR-joined query fits in NEWS_QUERY_MAX_CHARS."""
+    chunk, length = [], 0
+    for coin in coins:
+        term = len(coin) + 2  # quotes
+        extra = term + 4 if chunk else term  # " OR "
+        if chunk and length + extra > NEWS_QUERY_MAX_CHARS:
+            yield chunk
+            chunk, length, extra = [], 0, term
+        chunk.append(coin)
+        length += extra
+    if chunk:
+        yield chunk
+
+def _fetch_headlines_chunk(coins):
+    """
+    Fetches headlines for several coins with one '"a" OR "b"' NewsAPI query and
+    assigns each title to every coin it mentions. Returns ({coin: headlines},
+    truncated), where truncated means NewsAPI had more matches than one page.
+    """
+    news_response = _news_get(
+        "https://newsapi.org/v2/everything",
+        params={
+            'q': " OR ".join(f'"{coin}"' for coin in coins),
+            'searchIn': 'title',
+            'language': 'en',
+            'sortBy': 'publishedAt',
+            'pageSize': 100,
+        }
+    )
+    news_data = _news_json(news_response)
+
+    articles = news_data.get('articles', ())
+    found = {coin: [] for coin in coins}
+    patterns = {coin: re.compile(rf"\b{re.escape(coin)}\b") for coin in coins}
+    for article in articles:
+        title = article.get('title')
+        if not title or title == '[Removed]':
+            continue
+        lowered = title.lower()
+        for coin, pattern in patterns.items():
+            if len(found[coin]) < 5 and pattern.search(lowered):
+                found[coin].append(title)
+
+    return found, news_data.get('totalResults', 0) > len(articles)
+
+# At most this many coins per _fetch_headlines_many call are re-asked about on
+# their own after popular coins crowded them out of a truncated OR-query page.
+# Chunks holding bitcoin or ethereum are nearly always truncated, so the cap
+# keeps the daily quota cost close to one request per chunk.
+NEWS_REFETCH_MAX = 5
+
+def _fetch_headlines_many(coins):
+    """Returns {coin: headlines or Exception}, using one NewsAPI request per chunk of coins."""
+    results = {}
+    with _HEADLINES_CACHE_LOCK:
+        for coin in coins:
+            headlines = _HEADLINES_CACHE.get(coin)
+            if headlines is not None:
+                results[coin] = headlines
+
+    def fetch_chunk(chunk):
+        try:
+            return _fetch_headlines_chunk(chunk)
+        except Exception as e:
+            return {coin: e for coin in chunk}, False
+
+    fetched = {}
+    crowded_out = []
+    missing = [coin for coin in coins if coin not in results]
+    for found, truncated in IO_EXECUTOR.map(fetch_chunk, list(_chunk_news_query(missing))):
+        fetched.update(found)
+        if truncated:
+            crowded_out.extend(coin for coin, headlines in found.items() if not headlines)
+
+    # An empty result from a truncated page may just mean popular coins took all
+    # the slots; ask about a few of those coins on their own, concurrently
+    def fetch_single(coin):
+        try:
+            return _fetch_headlines_live(coin)
+        except Exception as e:
+            return e
+
+    refetch = crowded_out[:NEWS_REFETCH_MAX]
+    fetched.update(zip(refetch, IO_EXECUTOR.map(fetch_single, refetch)))
+
+    with _HEADLINES_CACHE_LOCK:
+        for coin, headlines in fetched.items():
+            if not isinstance(headlines, Exception):
+                _HEADLINES_CACHE[coin] = headlines
+    results.update(fetched)
+    return results
+
+def _analyze_sentiment_live(coin, headlines=None, stream=None):
+    """Fetches news and asks Gemini to analyze the sentiment, streaming into stream if given."""
+    client = get_gemini()
     if not NEWS_API_KEY:
         return "Error: NEWS_API_KEY not configured."
     if not client:
@@ -42,33 +477,126 @@ def analyze_sentiment(coin):
 
     try:
         # 1. Fetch the latest 5 news headlines
-        # properly encoding the coin for url might be needed but simple string usually works for coin names
-        news_url = f"https://newsapi.org/v2/everything?q={coin}&searchIn=title&language=en&sortBy=publishedAt&pageSize=5&apiKey={NEWS_API_KEY}"
-        news_response = requests.get(news_url)
-        news_data = news_response.json()
-        
-        if news_response.status_code != 200:
-             return f"Error fetching news: {news_data.get('message', 'Unknown error')}"
-
-        headlines = [article.get('title') for article in news_data.get('articles', [])[:5]]
+        if headlines is None:
+            headlines = _fetch_headlines(coin)
         
         if not headlines:
-            return f"No recent news found for {coin}."
+            return NO_NEWS
             
         # 2. Ask Gemini for Sentiment Analysis
         prompt = f"Analyze the overall market sentiment of these recent news headlines for {coin}. Reply with exactly one word (BULLISH, BEARISH, or NEUTRAL), followed by a short 1-sentence summary of why.\nHeadlines: {headlines}"
         
         # We use Gemini 2.0 Flash (or closest available)
         # Using a model name that is generally available or falling back
-        response = client.models.generate_content(
-            model='gemini-2.0-flash', 
+        if stream is not None:
+            return stream.feed(_gemini_stream(
+                client,
+                model='gemini-2.0-flash',
+                contents=prompt
+            )).strip()
+
+        response = _gemini_generate(
+            client,
+            model='gemini-2.0-flash',
             contents=prompt
         )
         
         return response.text.strip()
         
+    except NewsAPIError as e:
+        print(f"NewsAPI error for {coin}: {e}")
+        return NEWS_ERROR_REPLY
     except Exception as e:
-        return f"Error analyzing sentiment: {str(e)}"
+        print(f"Sentiment analysis failed for {coin}: {e}")
+        return SENTIMENT_ERROR_REPLY
+
+def _analyze_sentiment_batch_live(coins):
+    """Fetches news for every coin in as few NewsAPI calls as possible, then asks Gemini about them in concurrent batches."""
+    client = get_gemini()
+    if not NEWS_API_KEY:
+        return {coin: "Error: NEWS_API_KEY not configured." for coin in coins}
+    if not client:
+        return {coin: "Error: Gemini Client not initialized (check GEMINI_API_KEY)." for coin in coins}
+
+    # 1. Fetch headlines for all coins, a few OR-queries instead of one request each
+    headlines_map = _fetch_headlines_many(coins)
+
+    results = {}
+    for coin, headlines in list(headlines_map.items()):
+        if isinstance(headlines, NewsAPIError):
+            print(f"NewsAPI error for {coin}: {headlines}")
+            results[coin] = NEWS_ERROR_REPLY
+        elif isinstance(headlines, Exception):
+            print(f"Fetching news failed for {coin}: {headlines}")
+            results[coin] = SENTIMENT_ERROR_REPLY
+        elif not headlines:
+            results[coin] = NO_NEWS
+        else:
+            continue
+        del headlines_map[coin]
+
+    if not headlines_map:
+        return results
+
+    # 2. Gemini batches of GEMINI_BATCH_SIZE coins, all in flight at once
+    items = list(headlines_map.items())
+    batches = [dict(items[i:i + GEMINI_BATCH_SIZE]) for i in range(0, len(items), GEMINI_BATCH_SIZE)]
+
+    def ask_batch(batch):
+        return _gemini_verdicts(client, batch)
+
+    for answered in IO_EXECUTOR.map(ask_batch, batches):
+        results.update(answered)
+
+    # 3. Gemini skipped or mangled these coins, ask about each on its own
+    skipped = [coin for coin in headlines_map if coin not in results]
+
+    def ask_single(coin):
+        return _analyze_sentiment_live(coin, headlines_map[coin])
+
+    results.update(zip(skipped, IO_EXECUTOR.map(ask_single, skipped)))
+    return results
+
+# Coins per batched Gemini prompt, so the JSON reply stays well inside the
+# model's output token limit instead of coming back truncated
+GEMINI_BATCH_SIZE = 20
+
+def _gemini_verdicts(client, headlines_map):
+    """
+    Asks Gemini about several coins in one JSON-mode call.
+    Returns {coin: sentiment} for the coins it answered properly; the rest are left out.
+    """
+    prompt = (
+        "Analyze the overall market sentiment of the recent news headlines for each coin below. "
+        "Reply with a JSON object mapping each coin name to an object with the keys "
+        "\"verdict\" (exactly one of BULLISH, BEARISH, or NEUTRAL) and \"reason\" (a short 1-sentence summary of why).\n"
+        "Data:\n" + orjson.dumps(headlines_map).decode()
+    )
+    try:
+        response = _gemini_generate(
+            client,
+            model='gemini-2.0-flash',
+            contents=prompt,
+            config={'response_mime_type': 'application/json'}
+        )
+    except Exception as e:
+        print(f"Batch sentiment analysis failed: {e}")
+        return {coin: SENTIMENT_ERROR_REPLY for coin in headlines_map}
+
+    try:
+        verdicts = orjson.loads(response.text or '')
+    except orjson.JSONDecodeError:
+        return {}
+    if not isinstance(verdicts, dict):
+        return {}
+
+    answered = {}
+    for coin in headlines_map:
+        entry = verdicts.get(coin)
+        verdict = str(entry.get('verdict', '')).upper() if isinstance(entry, dict) else ''
+        if verdict in ('BULLISH', 'BEARISH', 'NEUTRAL') and entry.get('reason'):
+            answered[coin] = f"{verdict} - {entry['reason']}"
+    return answered
 
 def get_crypto_prices(coins):
     """
@@ -78,245 +606,685 @@ def get_crypto_prices(coins):
     if not coins:
         return {}
     
-    # join coins with comma
-    ids = ",".join(coins)
-    url = f"https://api.coingecko.com/api/v3/simple/price?ids={ids}&vs_currencies=usd&include_24hr_change=true"
-    
     try:
-        response = requests.get(url)
+        response = SESSION.get(
+            "https://api.coingecko.com/api/v3/simple/price",
+            params={
+                'ids': ",".join(coins),
+                'vs_currencies': 'usd',
+                'include_24hr_change': 'true',
+            },
+            timeout=HTTP_TIMEOUT
+        )
         if response.status_code == 200:
             return response.json()
         return {}
     except Exception:
         return {}
 
-@app.route('/api/webhook', methods=['POST'])
-def webhook():
-    update = request.get_json()
+class TokenBucket:
+    """Thread-safe token bucket. acquire() blocks until a token is available."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class AdaptiveTokenBucket(TokenBucket):
+    """
+    TokenBucket whose rate follows the upstream: it grows by `increase` on each
+    success and is cut by `decrease` on a 429/5xx, within [min_rate, max_rate].
+    Backing off client-side stops retries piling onto an API that is already
+    struggling (and burning quota on calls that will fail anyway).
+    """
+
+    def __init__(self, rate, capacity, min_rate, max_rate, increase=1.05, decrease=0.5):
+        super().__init__(rate, capacity)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate * self.increase)
+
+    def on_failure(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+
+    def record(self, status_code):
+        """Adjusts the rate from an HTTP status code."""
+        if status_code == 429 or status_code >= 500:
+            self.on_failure()
+        else:
+            self.on_success()
+
+NEWS_BUCKET = AdaptiveTokenBucket(rate=5, capacity=10, min_rate=0.5, max_rate=10)
+GEMINI_BUCKET = AdaptiveTokenBucket(rate=5, capacity=10, min_rate=0.5, max_rate=20)
+
+def _news_get(url, **kw):
+    """SESSION.get against NewsAPI, paced by NEWS_BUCKET."""
+    NEWS_BUCKET.acquire()
+    try:
+        # The key goes in a header so it never appears in a URL (or an exception quoting one)
+        response = SESSION.get(url, headers={'X-Api-Key': NEWS_API_KEY}, timeout=HTTP_TIMEOUT, **kw)
+    except requests.RequestException:
+        NEWS_BUCKET.on_failure()
+        raise
+    NEWS_BUCKET.record(response.status_code)
+    return response
+
+def _gemini_failed(e):
+    """Slows GEMINI_BUCKET down if e means Gemini is overloaded or unreachable."""
+    # google-genai API errors carry the HTTP status in .code; anything
+    # without one (timeouts, dropped connections) also counts against the host
+    code = getattr(e, 'code', None)
+    if not isinstance(code, int) or code == 429 or code >= 500:
+        GEMINI_BUCKET.on_failure()
+
+def _gemini_generate(client, **kw):
+    """client.models.generate_content, paced by GEMINI_BUCKET."""
+    GEMINI_BUCKET.acquire()
+    try:
+        response = client.models.generate_content(**kw)
+    except Exception as e:
+        _gemini_failed(e)
+        raise
+    GEMINI_BUCKET.on_success()
+    return response
+
+def _gemini_stream(client, **kw):
+    """client.models.generate_content_stream as a generator of text pieces, paced by GEMINI_BUCKET."""
+    GEMINI_BUCKET.acquire()
+    try:
+        for chunk in client.models.generate_content_stream(**kw):
+            if chunk.text:
+                yield chunk.text
+    except Exception as e:
+        _gemini_failed(e)
+        raise
+    GEMINI_BUCKET.on_success()
+
+# Telegram allows ~30 messages/s per bot and ~1 message/s per chat; stay just under,
+# and slow down further if it starts answering 429s.
+TELEGRAM_BUCKET = AdaptiveTokenBucket(rate=25, capacity=25, min_rate=1, max_rate=25)
+TELEGRAM_CHAT_INTERVAL = 1.0  # seconds
+_CHAT_NEXT_SEND = TTLCache(maxsize=10000, ttl=60)
+_CHAT_NEXT_SEND_LOCK = threading.Lock()
+# Longest 429 retry_after we are willing to sleep through before giving up
+TELEGRAM_MAX_RETRY_AFTER = 5
+
+def _wait_for_chat_slot(chat_id):
+    """Reserves the next per-chat send slot and sleeps until it arrives."""
+    with _CHAT_NEXT_SEND_LOCK:
+        now = time.monotonic()
+        slot = max(now, _CHAT_NEXT_SEND.get(chat_id, now))
+        _CHAT_NEXT_SEND[chat_id] = slot + TELEGRAM_CHAT_INTERVAL
+    if slot > now:
+        time.sleep(slot - now)
+
+SENTIMENT_EMOJI = {'BULLISH': "🟢", 'BEARISH': "🔴", 'NEUTRAL': "⚪"}
+
+def format_coin_line(coin, sentiment, coin_data):
+    """Formats one coin as an emoji, name, price and 24h change, with the sentiment below."""
+    # Determine Emoji
+    sent_upper = sentiment.upper()
+    verdict = "BULLISH" if "BULLISH" in sent_upper else "BEARISH" if "BEARISH" in sent_upper else "NEUTRAL"
+    emoji = SENTIMENT_EMOJI[verdict]
     
-    if not update:
-        return jsonify({'status': 'no data'}), 400
+    # Format Price Data
+    price = coin_data.get('usd', 'N/A')
+    change_24h = coin_data.get('usd_24h_change', 0)
+    
+    # Format change with arrow
+    change_str = ""
+    if isinstance(change_24h, (int, float)):
+        arrow = "⬆️" if change_24h >= 0 else "⬇️"
+        change_str = f" ({arrow} {change_24h:.2f}%)"
+    
+    return f"{emoji} **{coin.title()}**: ${price}{change_str}\n_{sentiment}_"
 
-    if 'message' in update and 'text' in update['message']:
-        chat_id = update['message']['chat']['id']
-        text = update['message']['text'].lower()
-        
-        # Command Handlers
-        if text.startswith('/start') or text.startswith('/help'):
-            reply_text = (
-                "💣 **Welcome to CryptoBobomb!**\n\n"
-                "I can analyze crypto sentiment and track prices for you.\n\n"
-                "**Commands:**\n"
-                "• `/sentiment [coin]` - AI analysis of news\n"
-                "• `/track [coin]` - Add to watchlist\n"
-                "• `/untrack [coin]` - Remove from watchlist\n"
-                "• `/watchlist` - View your list\n\n"
-                "Or just chat with me! I use Gemini 2.5 Pro. 🧠"
-            )
-            if TELEGRAM_TOKEN:
-                requests.post(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage", json={'chat_id': chat_id, 'text': reply_text, 'parse_mode': 'Markdown'})
-
-        # New AI Sentiment Skill
-        elif text.startswith('/sentiment'):
-            # Extract the coin name (e.g., "/sentiment solana")
-            parts = text.split(' ')
-            if len(parts) > 1:
-                coin = parts[1]
-                # notify user processing? Telegram bots usually just reply.
-                reply_text = analyze_sentiment(coin)
-            else:
-                reply_text = "Please provide a coin. Example: /sentiment bitcoin"
-            
-            # Send the reply back to Telegram
-            if TELEGRAM_TOKEN:
-                url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-                requests.post(url, json={'chat_id': chat_id, 'text': reply_text})
+def send_message(chat_id, text, **kw):
+    """Sends a Telegram message. Extra keyword arguments (e.g. parse_mode) go into the payload."""
+    if not SEND_URL:
+        print("TELEGRAM_TOKEN not set, cannot send reply.")
+        print(f"Would have sent: {text}")
+        return None
+    return _post_telegram(SEND_URL, chat_id, {'chat_id': chat_id, 'text': text, **kw})
+
+def _post_telegram(url, chat_id, fields):
+    """
+    POSTs a message-producing Telegram call (sendMessage, editMessageText),
+    paced per chat and globally, retrying once on a short 429.
+    """
+    payload = orjson.dumps(fields)
+
+    _wait_for_chat_slot(chat_id)
+    TELEGRAM_BUCKET.acquire()
+    response = SESSION.post(url, data=payload, headers=JSON_HEADERS, timeout=HTTP_TIMEOUT)
+    TELEGRAM_BUCKET.record(response.status_code)
+
+    if response.status_code == 429:
+        # Telegram tells us how long to back off in parameters.retry_after
+        try:
+            retry_after = response.json().get('parameters', {}).get('retry_after', 1)
+        except ValueError:
+            retry_after = 1
+        if retry_after <= TELEGRAM_MAX_RETRY_AFTER:
+            time.sleep(retry_after)
+            TELEGRAM_BUCKET.acquire()
+            response = SESSION.post(url, data=payload, headers=JSON_HEADERS, timeout=HTTP_TIMEOUT)
+            TELEGRAM_BUCKET.record(response.status_code)
+        else:
+            print(f"Telegram rate limited chat {chat_id} for {retry_after}s, dropping message.")
+    return response
+
+def send_typing(chat_id):
+    """
+    Shows "typing…" in the chat while a slow reply is prepared. The request runs
+    on IO_EXECUTOR; returns its future, or None if Telegram isn't configured.
+    Not throttled like send_message: chat actions don't count as messages.
+    """
+    if not CHAT_ACTION_URL:
+        return None
+    payload = orjson.dumps({'chat_id': chat_id, 'action': 'typing'})
+    return IO_EXECUTOR.submit(SESSION.post, CHAT_ACTION_URL, data=payload, headers=JSON_HEADERS, timeout=HTTP_TIMEOUT)
+
+def _settle(future):
+    """Waits for a send_typing future, so the action can't land after the reply and linger."""
+    if future is not None:
+        wait([future])
+
+class StreamedReply:
+    """
+    Shows a reply in a chat while Gemini is still generating it: the first piece
+    is sent as a message, which is then edited as more text arrives, at most
+    once per TELEGRAM_CHAT_INTERVAL. Waits for the typing future (if any) first.
+    """
+
+    def __init__(self, chat_id, typing=None):
+        self.chat_id = chat_id
+        self.typing = typing
+        self.message_id = None
+        self.shown = None
+        self.next_update = 0.0
+
+    def feed(self, pieces):
+        """Consumes text pieces, updating the message along the way. Returns the full text."""
+        text = ''
+        for piece in pieces:
+            text += piece
+            if time.monotonic() >= self.next_update:
+                self._show(text)
+        return text
+
+    def finish(self, text):
+        """
+        Makes the message show the final text. Returns text if nothing was sent
+        yet (cache hit, no news, early error), so the caller sends it as usual.
+        """
+        if self.message_id is None:
+            return text
+        self._show(text)
+        return None
+
+    def _show(self, text):
+        if not SEND_URL or not text.strip() or text == self.shown:
+            return
+        try:
+            if self.message_id is None:
+                _settle(self.typing)
+                response = send_message(self.chat_id, text)
+                if response.ok:
+                    self.message_id = response.json()['result']['message_id']
             else:
-                print("TELEGRAM_TOKEN not set, cannot send reply.")
-                print(f"Would have sent: {reply_text}")
-
-        # Watchlist Features
-        elif text.startswith('/track'):
-            parts = text.split(' ')
-            if len(parts) > 1 and supabase:
-                coin = parts[1].lower()
-                try:
-                    # Insert into Supabase table 'watchlist'
-                    # Assuming table structure: id (auto), chat_id, coin, (unique constraint on chat_id, coin)
-                    data, count = supabase.table('watchlist').insert({
-                        "chat_id": chat_id,
-                        "coin": coin
-                    }).execute()
-                    reply_text = f"Added {coin} to your watchlist."
-                except Exception as e:
-                    # Check for unique constraint violation (duplicate entry)
-                    if "duplicate key" in str(e) or "23505" in str(e): # PG error code for unique violation
-                        reply_text = f"{coin} is already in your watchlist."
-                    else:
-                        reply_text = f"Error adding coin: {str(e)}"
-                        print(f"Supabase error: {e}")
-            elif not supabase:
-                reply_text = "Database not configured."
+                response = _post_telegram(EDIT_URL, self.chat_id, {
+                    'chat_id': self.chat_id,
+                    'message_id': self.message_id,
+                    'text': text,
+                })
+            if response.ok:
+                self.shown = text
+        except requests.RequestException as e:
+            # A failed update shouldn't fail the analysis; the next one may get through
+            print(f"Failed to update streamed reply for {self.chat_id}: {e}")
+        self.next_update = time.monotonic() + TELEGRAM_CHAT_INTERVAL
+
+# Telegram rejects text over 4096 UTF-16 code units (most emoji count as two)
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+def _utf16_len(text):
+    return len(text.encode('utf-16-le')) // 2
+
+def _pack_blocks(blocks, sep="\n\n"):
+    """Joins blocks with sep into as few texts as fit within TELEGRAM_MESSAGE_LIMIT each."""
+    texts, current, size = [], [], 0
+    sep_len = _utf16_len(sep)
+    for block in blocks:
+        block_len = _utf16_len(block)
+        if current and size + sep_len + block_len > TELEGRAM_MESSAGE_LIMIT:
+            texts.append(sep.join(current))
+            current, size = [], 0
+        size += block_len + (sep_len if current else 0)
+        current.append(block)
+    if current:
+        texts.append(sep.join(current))
+    return texts
+
+def send_blocks(chat_id, blocks, **kw):
+    """
+    Sends blocks joined by blank lines, split across as many messages as the
+    length limit needs (never inside a block). Returns the first failed
+    response, otherwise the last one.
+    """
+    response = None
+    for text in _pack_blocks(blocks):
+        response = send_message(chat_id, text, **kw)
+        if response is None or not response.ok:
+            break
+    return response
+
+UNKNOWN_COIN_REPLY = "I don't know a coin called {coin}. Try its CoinGecko id, e.g. bitcoin."
+# Prices are looked up by id, so the watchlist only stores ids
+NOT_AN_ID_REPLY = "Please track {coin} by its CoinGecko id, e.g. bitcoin rather than btc."
+
+# Command Handlers
+# Each takes the chat id and the already-validated coin argument (may be empty)
+# and returns the reply: a text, or a list of blocks that may span several
+# messages. webhook() sends it.
+
+def handle_start(chat_id, coin):
+    reply_text = (
+        "💣 **Welcome to CryptoBobomb!**\n\n"
+        "I can analyze crypto sentiment and track prices for you.\n\n"
+        "**Commands:**\n"
+        "• `/sentiment [coin]` - AI analysis of news\n"
+        "• `/track [coin]` - Add to watchlist\n"
+        "• `/untrack [coin]` - Remove from watchlist\n"
+        "• `/watchlist` - View your list\n\n"
+        "Or just chat with me! I use Gemini 2.5 Pro. 🧠"
+    )
+    return reply_text
+
+# New AI Sentiment Skill
+def handle_sentiment(chat_id, coin):
+    if not coin:
+        reply_text = "Please provide a coin. Example: /sentiment bitcoin"
+    elif not is_known_coin(coin):
+        reply_text = UNKNOWN_COIN_REPLY.format(coin=coin)
+    else:
+        # Cache misses take a second or two (NewsAPI + Gemini); show "typing…"
+        # meanwhile, then Gemini's answer as it is generated
+        typing = send_typing(chat_id)
+        stream = StreamedReply(chat_id, typing)
+        reply_text = stream.finish(analyze_sentiment(coin, stream=stream))
+        _settle(typing)
+    return reply_text
+
+# Watchlist Features
+def handle_track(chat_id, coin):
+    supabase = get_supabase()
+    if coin and not is_known_coin(coin, ids_only=True):
+        reply_text = (NOT_AN_ID_REPLY if is_known_coin(coin) else UNKNOWN_COIN_REPLY).format(coin=coin)
+    elif coin and supabase:
+        try:
+            # Insert into Supabase table 'watchlist' (see supabase/schema.sql)
+            # The unique (chat_id, coin) constraint turns a duplicate into a no-op that returns no rows
+            response = supabase.table('watchlist').upsert({
+                "chat_id": chat_id,
+                "coin": coin
+            }, on_conflict='chat_id,coin', ignore_duplicates=True).execute()
+            if response.data:
+                reply_text = f"Added {coin} to your watchlist."
             else:
-                reply_text = "Usage: /track [coin]"
+                reply_text = f"{coin} is already in your watchlist."
+        except Exception as e:
+            reply_text = "Error adding coin. Please try again later."
+            print(f"Supabase error: {e}")
+    elif not supabase:
+        reply_text = "Database not configured."
+    else:
+        reply_text = "Usage: /track [coin]"
+    return reply_text
+
+def handle_untrack(chat_id, coin):
+    supabase = get_supabase()
+    if coin and supabase:
+        try:
+             # Delete from Supabase
+            data, count = supabase.table('watchlist').delete().match({
+                "chat_id": chat_id, 
+                "coin": coin
+            }).execute()
             
-            if TELEGRAM_TOKEN:
-                requests.post(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage", json={'chat_id': chat_id, 'text': reply_text})
-
-        elif text.startswith('/untrack'):
-            parts = text.split(' ')
-            if len(parts) > 1 and supabase:
-                coin = parts[1].lower()
-                try:
-                     # Delete from Supabase
-                    data, count = supabase.table('watchlist').delete().match({
-                        "chat_id": chat_id, 
-                        "coin": coin
-                    }).execute()
-                    
-                    # data[1] usually contains the deleted rows list in python client v2
-                    # But checking if list is empty is enough
-                    if data and len(data[1]) > 0:
-                         reply_text = f"Removed {coin} from your watchlist."
-                    else:
-                         reply_text = f"{coin} was not in your watchlist."
-                except Exception as e:
-                    reply_text = f"Error removing coin: {str(e)}"
-            elif not supabase:
-                reply_text = "Database not configured."
+            # data[1] usually contains the deleted rows list in python client v2
+            # But checking if list is empty is enough
+            if data and len(data[1]) > 0:
+                 reply_text = f"Removed {coin} from your watchlist."
             else:
-                reply_text = "Usage: /untrack [coin]"
+                 reply_text = f"{coin} was not in your watchlist."
+        except Exception as e:
+            reply_text = "Error removing coin. Please try again later."
+            print(f"Supabase error: {e}")
+    elif not supabase:
+        reply_text = "Database not configured."
+    else:
+        reply_text = "Usage: /untrack [coin]"
+    return reply_text
 
-            if TELEGRAM_TOKEN:
-                requests.post(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage", json={'chat_id': chat_id, 'text': reply_text})
+def handle_watchlist(chat_id, coin):
+    supabase = get_supabase()
+    if supabase:
+        try:
+            # One RPC returns the user's coins (sorted by Postgres) joined with the
+            # state the cron job keeps fresh
+            response = supabase.rpc('get_watchlist', {
+                "p_chat_id": chat_id,
+                "p_max_age_seconds": COIN_STATE_MAX_AGE
+            }).execute()
+            rows = response.data
+            coins = [row['coin'] for row in rows]
+            
+            if coins:
+                sentiments = {}
+                prices = {}
+                for row in rows:
+                    if row['sentiment'] is not None:
+                        sentiments[row['coin']] = row['sentiment']
+                        prices[row['coin']] = _price_data(row)
 
-        elif text.startswith('/watchlist'):
-            if supabase:
-                try:
-                    response = supabase.table('watchlist').select('coin').eq('chat_id', chat_id).execute()
-                    coins = [row['coin'] for row in response.data]
+                # Coins the cron job hasn't covered yet are fetched live
+                stale = [coin for coin in coins if coin not in sentiments]
+                if stale:
+                    # 1. Fetch Prices in Batch, in the background
+                    prices_future = IO_EXECUTOR.submit(get_crypto_prices, stale)
                     
-                    if coins:
-                        # 1. Fetch Prices in Batch
-                        prices = get_crypto_prices(coins)
-                        
-                        message_lines = ["📊 **Your Watchlist:**\n"]
-                        
-                        for coin in sorted(coins):
-                            # 2. Get Sentiment (this is still slow per coin, maybe cache later?)
-                            # For now, we do it live as requested.
-                            sentiment = analyze_sentiment(coin)
-                            
-                            # Determine Emoji
-                            if "BULLISH" in sentiment.upper():
-                                emoji = "🟢"
-                            elif "BEARISH" in sentiment.upper():
-                                emoji = "🔴"
-                            else:
-                                emoji = "⚪" # Neutral
-                            
-                            # Format Price Data
-                            coin_data = prices.get(coin, {})
-                            price = coin_data.get('usd', 'N/A')
-                            change_24h = coin_data.get('usd_24h_change', 0)
-                            
-                            # Format change with arrow
-                            change_str = ""
-                            if isinstance(change_24h, (int, float)):
-                                arrow = "⬆️" if change_24h >= 0 else "⬇️"
-                                change_str = f" ({arrow} {change_24h:.2f}%)"
-                            
-                            line = f"{emoji} **{coin.title()}**: ${price}{change_str}\n_{sentiment}_"
-                            message_lines.append(line)
-                        
-                        reply_text = "\n\n".join(message_lines)
-                    else:
-                        reply_text = "Your watchlist is empty. Use /track [coin] to add one."
-                except Exception as e:
-                    reply_text = f"Error fetching watchlist: {str(e)}"
+                    # 2. Meanwhile get Sentiments in one batched Gemini call
+                    sentiments.update(analyze_sentiment_batch(stale))
+                    prices.update(prices_future.result())
+
+                reply_blocks = [
+                    "📊 **Your Watchlist:**\n",
+                    *(format_coin_line(coin, sentiments[coin], prices.get(coin, {})) for coin in coins)
+                ]
             else:
-                reply_text = "Database not configured."
+                reply_blocks = ["Your watchlist is empty. Use /track [coin] to add one."]
+        except Exception as e:
+            reply_blocks = ["Error fetching watchlist. Please try again later."]
+            print(f"Watchlist error: {e}")
+    else:
+        reply_blocks = ["Database not configured."]
 
-            if TELEGRAM_TOKEN:
-                requests.post(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage", json={'chat_id': chat_id, 'text': reply_text, 'parse_mode': 'Markdown'})
+    return reply_blocks
 
-        # Natural Language Conversation Fallback
-        elif not text.startswith('/'):
+# Natural Language Conversation Fallback
+def handle_chat(chat_id, text):
+    client = get_gemini()
+    typing = send_typing(chat_id)
+    try:
+        # Use Gemini for general conversation
+        chat_prompt = f"You are a helpful and witty crypto assistant named CryptoBobomb. The user said: '{text}'. Reply directly to them, keeping it concise and fun, but still technical."
+        
+        response = _gemini_generate(
+            client,
+            model='gemini-2.0-flash',
+            contents=chat_prompt
+        )
+        reply_text = response.text.strip()
+    except Exception as e:
+        print(f"Error in chat: {e}")
+        reply_text = "⚠️ Sorry, I ran into an error. Please try again later."
+    _settle(typing)
+    return reply_text
+
+COMMANDS = {
+    'start': handle_start,
+    'help': handle_start,
+    'sentiment': handle_sentiment,
+    'track': handle_track,
+    'untrack': handle_untrack,
+    'watchlist': handle_watchlist,
+}
+# Commands whose replies are formatted with Markdown
+MARKDOWN_COMMANDS = frozenset({'start', 'help', 'watchlist'})
+
+# /command, an optional @BotName (Telegram adds it in groups), and the rest of the text
+_CMD_RE = re.compile(r'^/([a-z]+)(?:@\w+)?(?:\s+(.*))?$', re.DOTALL)
+# Commands that take a coin; their argument must be a single coin-like word, so
+# anything else never reaches NewsAPI or Supabase. The others ignore trailing
+# text (e.g. the payload of a /start deep link).
+COIN_COMMANDS = frozenset({'sentiment', 'track', 'untrack'})
+_COIN_RE = re.compile(r'[a-z0-9\-]{1,40}')
+
+# The webhook's replies never change, so build them once
+_OK = (b'{"status":"ok"}', 200, JSON_HEADERS)
+_NO_DATA = (b'{"status":"no data"}', 400, JSON_HEADERS)
+
+@app.route('/api/webhook', methods=['POST'])
+def webhook():
+    try:
+        update = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        update = None
+    
+    if not update or not isinstance(update, dict):
+        return _NO_DATA
+
+    if 'message' in update and 'text' in update['message']:
+        chat_id = update['message']['chat']['id']
+        text = update['message']['text'].lower()
+
+        reply, cmd = None, None
+        if not text.startswith('/'):
+            reply = handle_chat(chat_id, text)
+        else:
+            match = _CMD_RE.match(text)
+            cmd = match.group(1) if match else None
+            handler = COMMANDS.get(cmd)
+            if handler:
+                arg = (match.group(2) or '').strip() if cmd in COIN_COMMANDS else ''
+                if not arg or _COIN_RE.fullmatch(arg):
+                    reply = handler(chat_id, arg)
+                else:
+                    # A malformed coin argument: answer without calling out anywhere
+                    reply = f"That doesn't look like a coin. Use one word, e.g. /{cmd} bitcoin"
+
+        if reply:
+            kw = {'parse_mode': 'Markdown'} if cmd in MARKDOWN_COMMANDS else {}
             try:
-                # Use Gemini for general conversation
-                chat_prompt = f"You are a helpful and witty crypto assistant named CryptoBobomb. The user said: '{text}'. Reply directly to them, keeping it concise and fun, but still technical."
-                
-                response = client.models.generate_content(
-                    model='gemini-2.0-flash', 
-                    contents=chat_prompt
-                )
-                reply_text = response.text.strip()
-                
-                url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-                requests.post(url, json={'chat_id': chat_id, 'text': reply_text})
-            except Exception as e:
-                print(f"Error in chat: {e}")
-                error_text = f"⚠️ Sorry, I ran into an error: {str(e)}"
-                if TELEGRAM_TOKEN:
-                    requests.post(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage", json={'chat_id': chat_id, 'text': error_text})
-
-    return jsonify({'status': 'ok'}), 200
-
-# @app.route('/api/cron', methods=['GET'])
-# def cron_job():
-#     """
-#     Cron job triggered every 30 minutes.
-#     Iterates through all users' watchlists and sends updates.
-#     """
-#     # Verify the request is from Vercel Cron (optional security check for header)
-#     # if request.headers.get('Authorization') != ...: pass
-#
-#     if not supabase or not TELEGRAM_TOKEN:
-#         return jsonify({'error': 'Config missing'}), 500
-#
-#     processed_users = 0
-#     
-#     try:
-#         # Fetch ALL watchlist items
-#         # In production with large data, paginate this or process in batches
-#         response = supabase.table('watchlist').select('*').execute()
-#         all_rows = response.data
-#         
-#         # Group by chat_id: { chat_id: [coin1, coin2] }
-#         user_coins = {}
-#         for row in all_rows:
-#             cid = row['chat_id']
-#             coin = row['coin']
-#             if cid not in user_coins:
-#                 user_coins[cid] = []
-#             user_coins[cid].append(coin)
-#             
-#         for cid, coins in user_coins.items():
-#             if not coins:
-#                 continue
-#
-#             messages = []
-#             for coin in coins:
-#                 # We reuse the analyze_sentiment function
-#                 sentiment = analyze_sentiment(coin)
-#                 messages.append(f"**{coin.upper()}**: {sentiment}")
-#
-#             if messages:
-#                 full_message = "⏰ **30-Minute Update**\n\n" + "\n\n".join(messages)
-#                 
-#                 # Send to user
-#                 url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-#                 try:
-#                     requests.post(url, json={'chat_id': cid, 'text': full_message, 'parse_mode': 'Markdown'})
-#                     processed_users += 1
-#                 except Exception as e:
-#                     print(f"Failed to send to {cid}: {e}")
-#
-#     except Exception as e:
-#         print(f"Cron job error: {e}")
-#         return jsonify({'error': str(e)}), 500
-#
-#     return jsonify({'status': 'ok', 'users_notified': processed_users}), 200
+                send_blocks(chat_id, [reply] if isinstance(reply, str) else reply, **kw)
+            except requests.RequestException as e:
+                # Still answer 200: a 5xx makes Telegram redeliver the update,
+                # re-running the whole command and sending duplicates
+                print(f"Failed to reply to {chat_id}: {e}")
+
+    return _OK
+
+# PostgREST returns at most max_rows (1000 on Supabase) rows per select
+WATCHLIST_PAGE_SIZE = 1000
+
+def _iter_watchlist_rows(supabase):
+    """Yields every watchlist row ordered by (chat_id, coin), one page at a time."""
+    start = 0
+    while True:
+        rows = (
+            supabase.table('watchlist').select('chat_id,coin').order('chat_id').order('coin')
+            .range(start, start + WATCHLIST_PAGE_SIZE - 1).execute().data
+        )
+        yield from rows
+        if len(rows) < WATCHLIST_PAGE_SIZE:
+            return
+        start += WATCHLIST_PAGE_SIZE
+
+@app.route('/api/cron', methods=['GET'])
+def cron_job():
+    """
+    Cron job triggered every 30 minutes.
+    Iterates through all users' watchlists and sends updates.
+    """
+    # Vercel Cron sends "Authorization: Bearer <CRON_SECRET>". Without a secret
+    # configured, anyone could trigger a full fan-out, so refuse outright.
+    if not CRON_SECRET:
+        return jsonify({'error': 'CRON_SECRET not configured'}), 503
+    # Compared as bytes, since compare_digest raises on non-ASCII str arguments.
+    # WSGI decodes headers as latin-1, so this recovers the bytes as sent.
+    authorization = request.headers.get('Authorization', '').encode('latin-1')
+    if not hmac.compare_digest(authorization, f"Bearer {CRON_SECRET}".encode()):
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    supabase = get_supabase()
+
+    if not supabase or not TELEGRAM_TOKEN:
+        return jsonify({'error': 'Config missing'}), 500
+
+    try:
+        # Fetch ALL watchlist items, ordered so each user's rows are adjacent and
+        # their coins already alphabetical (Postgres sorts via the unique index)
+        # Group by chat_id: { chat_id: [coin1, coin2] }
+        user_coins = {
+            cid: [row['coin'] for row in rows]
+            for cid, rows in groupby(_iter_watchlist_rows(supabase), key=itemgetter('chat_id'))
+        }
+
+        all_coins = sorted({coin for coins in user_coins.values() for coin in coins})
+
+        if queue:
+            # Hand everything to the workers and return right away. User jobs wait
+            # for the refresh so they read its sentiments from the shared cache
+            # instead of recomputing the same coins in parallel.
+            refresh_job = queue.enqueue(refresh_coin_state, all_coins)
+            queue.enqueue_many([
+                Queue.prepare_data(send_cron_update, (cid, coins), depends_on=refresh_job)
+                for cid, coins in user_coins.items()
+            ])
+            return jsonify({'status': 'ok', 'users_queued': len(user_coins)}), 200
+
+        # One CoinGecko call and one sentiment batch cover every user's coins.
+        # The same results refresh the coin_state table that /watchlist reads from.
+        sentiments, prices = refresh_coin_state(all_coins)
+
+        # Users are independent, so fan them out as well
+        def notify(item):
+            cid, coins = item
+            return send_cron_update(
+                cid, coins,
+                prices={coin: prices[coin] for coin in coins if coin in prices},
+                sentiments={coin: sentiments[coin] for coin in coins}
+            )
+
+        with ThreadPoolExecutor(max_workers=CRON_WORKERS) as ex:
+            results = list(ex.map(notify, user_coins.items()))
+        processed_users = sum(results)
+
+    except Exception as e:
+        print(f"Cron job error: {e}")
+        return jsonify({'error': 'Cron job failed'}), 500
+
+    return jsonify({'status': 'ok', 'users_notified': processed_users}), 200
+
+def refresh_coin_state(coins):
+    """
+    Stores the latest sentiment and price for every coin in coin_state.
+    Returns the ({coin: sentiment}, {coin: price data}) it fetched.
+    """
+    supabase = get_supabase()
+    if not coins:
+        return {}, {}
+
+    prices_future = IO_EXECUTOR.submit(get_crypto_prices, coins)
+    # Always recompute: reading the cache first would hand back the previous
+    # run's entries, which live longer than the cron period. What we compute is
+    # cached until just after the next run, so /sentiment for any tracked coin
+    # is answered from cache instead of NewsAPI + Gemini.
+    fresh = _analyze_sentiment_batch_live(coins)
+    _cache_put(fresh, ttl=COIN_STATE_MAX_AGE)
+    sentiments = {coin: _present(coin, sentiment) for coin, sentiment in fresh.items()}
+    prices = prices_future.result()
+
+    updated_at = datetime.now(timezone.utc).isoformat()
+    rows = [
+        {
+            "coin": coin,
+            "sentiment": sentiments[coin],
+            "price": prices.get(coin, {}).get('usd'),
+            "change_24h": prices.get(coin, {}).get('usd_24h_change'),
+            "updated_at": updated_at
+        }
+        for coin in coins
+        if not sentiments[coin].startswith("Error")
+    ]
+    if rows:
+        try:
+            supabase.table('coin_state').upsert(rows).execute()
+        except Exception as e:
+            print(f"coin_state refresh failed: {e}")
+    return sentiments, prices
+
+def _price_data(row):
+    """Turns a coin_state row into the CoinGecko-style price data format_coin_line expects."""
+    return {
+        key: value for key, value in (('usd', row['price']), ('usd_24h_change', row['change_24h']))
+        if value is not None
+    }
+
+def _read_coin_prices(coins):
+    """Returns {coin: price data} from the fresh coin_state rows for coins, in one query."""
+    supabase = get_supabase()
+    if not supabase or not coins:
+        return {}
+    try:
+        since = (datetime.now(timezone.utc) - timedelta(seconds=COIN_STATE_MAX_AGE)).isoformat()
+        response = (
+            supabase.table('coin_state').select('coin,price,change_24h')
+            .in_('coin', coins).gt('updated_at', since).execute()
+        )
+        return {row['coin']: _price_data(row) for row in response.data}
+    except Exception as e:
+        print(f"coin_state price read failed: {e}")
+        return {}
+
+def send_cron_update(cid, coins, prices=None, sentiments=None):
+    """
+    Builds and sends the periodic update for one user. Returns True if sent.
+    Queued jobs leave prices/sentiments unset: they read the prices the refresh
+    job stored in coin_state and the sentiments it cached.
+    """
+    if not coins:
+        return False
+
+    if prices is None:
+        prices = _read_coin_prices(coins)
+    if sentiments is None:
+        sentiments = analyze_sentiment_batch(coins)
+    blocks = ["⏰ **30-Minute Update**"]
+    blocks.extend(format_coin_line(coin, sentiments[coin], prices.get(coin, {})) for coin in coins)
+
+    # Send to user
+    try:
+        response = send_blocks(cid, blocks, parse_mode='Markdown')
+    except Exception as e:
+        print(f"Failed to send to {cid}: {e}")
+        return False
+    # Telegram answers e.g. 403 when the user blocked the bot; that's not a notification
+    if response is None or not response.ok:
+        print(f"Failed to send to {cid}: HTTP {getattr(response, 'status_code', None)}")
+        return False
+    return True
 
 # Vercel requires a handler for serverless functions, often `app` is enough if using Flask with Vercel adapter or WSGI
 # But for `vercel.json` rewrites to work with standard Flask in some setups, we might need:
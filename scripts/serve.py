@@ -0,0 +1,32 @@
+import os
+import sys
+
+# gevent (optional) has to patch sockets and threads before requests,
+# urllib3 and the app are imported, so this runs first.
+try:
+    from gevent import monkey
+    monkey.patch_all()
+    from gevent.pywsgi import WSGIServer
+except ImportError:
+    WSGIServer = None
+
+# Make `api.webhook` importable when run as `python scripts/serve.py`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api.webhook import app
+
+def serve(port):
+    """
+    Runs the bot locally for development and benchmarking.
+    Uses gevent when it is installed, otherwise Werkzeug's threaded server,
+    so a slow /api/cron run doesn't block webhook requests.
+    """
+    if WSGIServer:
+        print(f"Serving on http://0.0.0.0:{port} (gevent)")
+        WSGIServer(('0.0.0.0', port), app).serve_forever()
+    else:
+        print("gevent not installed, falling back to Werkzeug's threaded server.")
+        app.run(host='0.0.0.0', port=port, threaded=True)
+
+if __name__ == "__main__":
+    serve(int(sys.argv[1]) if len(sys.argv) > 1 else int(os.environ.get("PORT", 8000)))
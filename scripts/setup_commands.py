@@ -25,7 +25,7 @@ def setup_commands():
     url = f"https://api.telegram.org/bot{token}/setMyCommands"
     
     try:
-        response = requests.post(url, json={"commands": commands})
+        response = requests.post(url, json={"commands": commands}, timeout=10)
         response.raise_for_status()
         
         result = response.json()
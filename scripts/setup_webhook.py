@@ -31,7 +31,7 @@ def setup_webhook(vercel_url):
     tg_url = f"https://api.telegram.org/bot{token}/setWebhook"
 
     try:
-        response = requests.post(tg_url, data={"url": webhook_url})
+        response = requests.post(tg_url, data={"url": webhook_url}, timeout=10)
         response.raise_for_status()
         
         result = response.json()
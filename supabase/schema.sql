@@ -0,0 +1,40 @@
+-- Tables used by api/webhook.py. Run in the Supabase SQL editor.
+
+-- One row per (user, coin) being tracked.
+create table if not exists watchlist (
+    id bigint generated by default as identity primary key,
+    chat_id bigint not null,
+    coin text not null,
+    unique (chat_id, coin)
+);
+
+-- Shared sentiment cache so serverless instances reuse each other's results.
+create table if not exists sentiment_cache (
+    coin text primary key,
+    sentiment text not null,
+    expires_at timestamptz not null
+);
+
+-- Latest sentiment and price per coin, refreshed by the /api/cron job.
+create table if not exists coin_state (
+    coin text primary key,
+    sentiment text,
+    price numeric,
+    change_24h numeric,
+    updated_at timestamptz not null default now()
+);
+
+-- Everything /watchlist needs in one round trip. State older than
+-- p_max_age_seconds comes back as nulls so the caller fetches it live.
+create or replace function get_watchlist(p_chat_id bigint, p_max_age_seconds integer default 2100)
+returns table (coin text, sentiment text, price numeric, change_24h numeric)
+language sql stable
+as $$
+    select w.coin, s.sentiment, s.price, s.change_24h
+    from watchlist w
+    left join coin_state s
+        on s.coin = w.coin
+        and s.updated_at > now() - make_interval(secs => p_max_age_seconds)
+    where w.chat_id = p_chat_id
+    order by w.coin;
+$$;